@@ -7,7 +7,12 @@ Collect data from UPS/PDU using NUT.
 
 from __future__ import with_statement
 import os
+import re
+import shutil
+import socket
 import subprocess
+import sys
+import threading
 import time
 
 import weewx.drivers
@@ -38,7 +43,7 @@ except ImportError:
         logmsg(syslog.LOG_ERR, msg)
 
 DRIVER_NAME = 'NUT'
-DRIVER_VERSION = '0.2'
+DRIVER_VERSION = '0.3'
 
 def loader(config_dict, _):
     return NUTDriver(**config_dict[DRIVER_NAME])
@@ -72,6 +77,9 @@ INFO_FIELDS = [
     'ups.realpower.nominal',
 ]
 
+# the NUT key, as bytes, and the label for each of the info fields
+INFO_MAP = tuple((f.encode('utf-8'), f) for f in INFO_FIELDS)
+
 # these are fields that we report in each observation cycle.  the names that
 # show up as observations are these fields with the period replaced by an
 # underscore.  the underscore names are what we use as the database fields.
@@ -84,6 +92,11 @@ OBS_FIELDS = [
     'ups.load',
 ]
 
+# the NUT key, as bytes, and the database field name for each observation.
+# computed once so that nothing needs to be converted for each packet.
+OBS_MAP = tuple((f.encode('utf-8'), sys.intern(f.replace('.', '_')))
+                for f in OBS_FIELDS)
+
 schema = [('dateTime', 'INTEGER NOT NULL UNIQUE PRIMARY KEY'),
           ('usUnits', 'INTEGER NOT NULL'),
           ('interval', 'INTEGER NOT NULL'),
@@ -112,6 +125,9 @@ class NUTConfigurationEditor(weewx.drivers.AbstractConfEditor):
     driver = user.nut
     # The name of the device, defined in the NUT configuration ups.conf
     device = REPLACE_ME
+    # The host and port of the NUT server (upsd)
+    host = localhost
+    port = 3493
 """
     def prompt_for_settings(self):
         print("Specify the name of the device as it appears in ups.conf")
@@ -122,62 +138,203 @@ class NUTDriver(weewx.drivers.AbstractDevice):
 
     def __init__(self, **stn_dict):
         loginf('driver version is %s' % DRIVER_VERSION)
-        path = stn_dict.get('path', None)
-        ld_library_path = stn_dict.get('ld_library_path', None)
         self._device = stn_dict.get('device', 'ups')
         loginf('device=%s' % self._device)
-        self._poll_interval = stn_dict.get('poll_interval', 30)
+        self._poll_interval = int(stn_dict.get('poll_interval', 30))
         loginf('poll_interval=%s' % self._poll_interval)
-        self._cmd = ['upsc', self._device]
-        loginf("cmd='%s'" % ' '.join(self._cmd))
-        pairs = run_cmd(self._cmd)
-        self._model = pairs.get('device.model', 'NUT')
+        self._max_tries = int(stn_dict.get('max_tries', 5))
+        loginf('max_tries=%s' % self._max_tries)
+        host = stn_dict.get('host', 'localhost')
+        port = int(stn_dict.get('port', NUTClient.DEFAULT_PORT))
+        loginf('host=%s port=%s' % (host, port))
+        # keep socket waits short so that closePort can interrupt a read
+        self._client = NUTClient(host, port,
+                                 timeout=max(1, self._poll_interval / 2))
+        self._stop = threading.Event()
+        # LIST VAR includes the device.* and driver.* info fields, so ask
+        # the same server we will poll.  if it is not available yet, carry
+        # on and let genLoopPackets keep trying.
+        try:
+            pairs = self._client.list_vars(self._device)
+        except weewx.WeeWxIOError as e:
+            logerr('cannot get device info: %s' % e)
+            pairs = dict()
+        self._model = pairs.get(b'device.model', b'NUT').decode('utf-8',
+                                                                'replace')
         loginf('model=%s' % self._model)
-        for label in INFO_FIELDS:
-            loginf('%s=%s' % (label, pairs.get(label)))
+        # report the device info as a single log message
+        info = []
+        for key, label in INFO_MAP:
+            value = pairs.get(key)
+            if value is not None:
+                value = value.decode('utf-8', 'replace')
+            info.append('%s=%s' % (label, value))
+        loginf('info: %s' % ' '.join(info))
 
     def closePort(self):
-        pass
+        self._stop.set()
+        self._client.close()
 
     @property
     def hardware_name(self):
         return self._model
 
     def genLoopPackets(self):
-        cmd = ['upsc', self._device]
-        while True:
+        ntries = 0
+        while not self._stop.is_set():
             packet = {
-                'dateTime': int(time.time() + 0.5),
+                'dateTime': (time.time_ns() + 500000000) // 1000000000,
                 'usUnits': weewx.US,
             }
-            pairs = run_cmd(cmd)
-            for field in OBS_FIELDS:
-                if field in pairs:
-                    name = field.replace('.', '_')
-                    packet[name] = float(pairs[field])
+            try:
+                pairs = self._client.list_vars(self._device)
+                ntries = 0
+            except weewx.WeeWxIOError as e:
+                if self._stop.is_set():
+                    break
+                # the client reconnects on the next request, so wait for
+                # the next poll and try again before giving up
+                ntries += 1
+                logerr('read failed (%s of %s): %s' %
+                       (ntries, self._max_tries, e))
+                if ntries >= self._max_tries:
+                    raise
+                self._stop.wait(self._poll_interval)
+                continue
+            for key, name in OBS_MAP:
+                value = pairs.get(key)
+                if value is not None:
+                    packet[name] = float(value)
             yield packet
-            time.sleep(self._poll_interval)
+            self._stop.wait(self._poll_interval)
 
-def run_cmd(cmd, path=None, ld_library_path=None):
-    logdbg("run command '%s'" % ' '.join(cmd))
+
+class NUTClient(object):
+    """Minimal client for the NUT network protocol.  The connection to upsd
+    is opened on first use and kept open across polls.  If the connection
+    fails it is dropped and reopened on the next request."""
+
+    DEFAULT_PORT = 3493
+    VAR_RE = re.compile(br'VAR \S+ (\S+) "((?:[^"\\]|\\.)*)"')
+    ESC_RE = re.compile(br'\\(.)')
+
+    def __init__(self, host='localhost', port=DEFAULT_PORT, timeout=10):
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._sock = None
+        self._buf = bytearray()
+        self._closed = False
+
+    def connect(self):
+        logdbg("connect to %s:%s" % (self._host, self._port))
+        self._sock = socket.create_connection((self._host, self._port),
+                                              self._timeout)
+        self._buf = bytearray()
+        self._closed = False
+
+    def close(self):
+        self._closed = True
+        sock = self._sock
+        self._sock = None
+        if sock is not None:
+            # shut down before closing, since closing the socket does not
+            # wake a recv that is blocked in another thread
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (OSError, socket.error):
+                pass
+            try:
+                sock.close()
+            except (OSError, socket.error):
+                pass
+
+    def list_vars(self, device):
+        """Return a dict of variable name to value for the indicated device.
+        Both names and values are bytes, exactly as sent by the server."""
+        try:
+            if self._sock is None:
+                self.connect()
+            return self._list_vars(device)
+        except weewx.WeeWxIOError:
+            raise
+        except (OSError, socket.error) as e:
+            self.close()
+            raise weewx.WeeWxIOError("failed to list vars for '%s' from "
+                                     "%s:%s: %s" %
+                                     (device, self._host, self._port, e))
+
+    def _list_vars(self, device):
+        sock = self._sock
+        if self._closed or sock is None:
+            raise socket.error('connection closed by client')
+        sock.sendall(b'LIST VAR ' + device.encode('utf-8') + b'\n')
+        pairs = dict()
+        while True:
+            line = self._readline()
+            if line.startswith(b'END LIST VAR'):
+                break
+            if line.startswith(b'ERR '):
+                msg = line[4:].decode('utf-8', 'replace').strip()
+                raise weewx.WeeWxIOError("server error for '%s': %s" %
+                                         (device, msg))
+            m = NUTClient.VAR_RE.match(line)
+            if m:
+                pairs[m.group(1)] = NUTClient.ESC_RE.sub(br'\1', m.group(2))
+        return pairs
+
+    def _readline(self):
+        # read from the socket in large chunks and hand out one line at a
+        # time, so that a whole LIST VAR response costs only a few recv calls
+        while True:
+            idx = self._buf.find(b'\n')
+            if idx >= 0:
+                line = bytes(self._buf[:idx + 1])
+                del self._buf[:idx + 1]
+                return line
+            sock = self._sock
+            if self._closed or sock is None:
+                raise socket.error('connection closed by client')
+            chunk = sock.recv(65536)
+            if not chunk:
+                raise socket.error('connection closed by %s' %
+                                   ('client' if self._closed else 'server'))
+            self._buf.extend(chunk)
+
+
+def make_env(path=None, ld_library_path=None):
+    """Return a copy of the process environment with the indicated PATH
+    prefix and LD_LIBRARY_PATH, for use with run_cmd."""
     env = os.environ.copy()
     if path:
-        env['PATH'] = path + ':' + env['PATH']
+        env['PATH'] = path + ':' + env.get('PATH', os.defpath)
     if ld_library_path:
         env['LD_LIBRARY_PATH'] = ld_library_path
+    return env
+
+def run_cmd(cmd, env=None):
+    """Run the command and return a dict of the name/value pairs that it
+    prints.  Both names and values are bytes.  If no environment is given,
+    the command inherits the environment of this process."""
+    logdbg("run command '%s'" % ' '.join(cmd))
     pairs = dict()
     try:
-        p = subprocess.Popen(cmd,
-                             env=env,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
-        o = p.communicate()[0].decode('utf-8')
-        for line in o.split('\n'):
-            parts = line.split(':')
-            if len(parts) == 2:
-                name = parts[0].strip()
-                value = parts[1].strip()
-                pairs[name] = value
+        # upsc stderr is not used, so discard it rather than let it fill
+        # a pipe that nobody reads while stdout is being consumed
+        with subprocess.Popen(cmd,
+                              env=env,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL,
+                              close_fds=True) as p:
+            # upsc prints one 'name: value' pair per line.  split only on
+            # the first colon, since values such as urls may contain colons.
+            for line in p.stdout:
+                name, sep, value = line.partition(b':')
+                if sep:
+                    pairs[name.strip()] = value.strip()
+        if p.returncode:
+            logdbg("command '%s' exited with status %s" %
+                   (' '.join(cmd), p.returncode))
     except (OSError, ValueError) as e:
         raise weewx.WeeWxIOError("failed process '%s': %s" %
                                  (' '.join(cmd), e))
@@ -189,7 +346,9 @@ def main():
     from weeutil.weeutil import to_sorted_string
 
     usage = """%prog [--debug] [--help] [--version]
-        [--path=PATH] [--ld_library_path=LD_LIBRARY_PATH]
+        [--device=DEVICE] [--host=HOST] [--port=PORT]
+        [--poll-interval=N] [--max-tries=N]
+        [--upsc [--path=PATH] [--ld_library_path=LD_LIBRARY_PATH]]
     """
 
     parser = optparse.OptionParser(usage=usage)
@@ -197,14 +356,22 @@ def main():
                       help='display driver version')
     parser.add_option('--debug', action='store_true',
                       help='display diagnostic information while running')
+    parser.add_option('--upsc', action='store_true',
+                      help='query the device once using upsc, then exit')
     parser.add_option('--path',
-                      help='value for PATH')
+                      help='value for PATH when running upsc')
     parser.add_option('--ld_library_path',
-                      help='value for LD_LIBRARY_PATH')
+                      help='value for LD_LIBRARY_PATH when running upsc')
     parser.add_option('--device', default='ups',
                       help='device name from ups.conf')
+    parser.add_option('--host', default='localhost',
+                      help='host on which the nut server is running')
+    parser.add_option('--port', type='int', default=NUTClient.DEFAULT_PORT,
+                      help='port on which the nut server is listening')
     parser.add_option('--poll-interval',
                       help='how often to poll the nut server')
+    parser.add_option('--max-tries',
+                      help='how many failed polls in a row before giving up')
 
     (options, args) = parser.parse_args()
 
@@ -215,17 +382,28 @@ def main():
     if options.debug:
         weewx.debug = 1
 
+    if options.upsc:
+        env = make_env(options.path, options.ld_library_path)
+        # resolve upsc once so that exec does not have to search PATH
+        upsc = shutil.which('upsc', path=env.get('PATH')) or 'upsc'
+        target = '%s@%s:%s' % (options.device, options.host, options.port)
+        pairs = run_cmd([upsc, target], env)
+        for name in sorted(pairs):
+            print('%s: %s' % (name.decode('utf-8', 'replace'),
+                              pairs[name].decode('utf-8', 'replace')))
+        exit(0)
+
     config_dict = {
         'NUT': {
             'device': options.device,
+            'host': options.host,
+            'port': options.port,
         }
     }
-    if options.path:
-        config_dict['NUT']['path'] = options.path
-    if options.ld_library_path:
-        config_dict['NUT']['ld_library_path'] = options.ld_library_path
     if options.poll_interval:
         config_dict['NUT']['poll_interval'] = int(options.poll_interval)
+    if options.max_tries:
+        config_dict['NUT']['max_tries'] = int(options.max_tries)
 
     driver = loader(config_dict, None)
 